@@ -13,12 +13,49 @@ This is a Streamlit app version of the subagents example.
 
 import streamlit as st
 import asyncio
+import atexit
+import json
 import logging
-from claude_agent_sdk import ClaudeSDKClient, ClaudeAgentOptions, AgentDefinition
+import queue
+import re
+import threading
+import time
+import weakref
+from concurrent.futures import Future, wait as wait_for_futures
+from dataclasses import dataclass, replace
+from types import SimpleNamespace
+from claude_agent_sdk import (
+    query,
+    ClaudeSDKClient,
+    ClaudeAgentOptions,
+    AgentDefinition,
+    AssistantMessage,
+    Message,
+    ResultMessage,
+    TextBlock,
+    ToolResultBlock,
+    ToolUseBlock,
+    UserMessage
+)
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Decode the CLI's stream-json frames with orjson when it is installed. Only the SDK's transport
+# module is patched: writes keep the stdlib encoder, and orjson's decode error subclasses
+# json.JSONDecodeError, which the transport relies on to buffer partial lines.
+try:
+    import orjson
+    from claude_agent_sdk._internal.transport import subprocess_cli
+except ImportError:
+    pass
+else:
+    subprocess_cli.json = SimpleNamespace(
+        loads=orjson.loads,
+        dumps=json.dumps,
+        JSONDecodeError=json.JSONDecodeError
+    )
+
 # Configure logging to console
 logging.basicConfig(
     level=logging.INFO,
@@ -33,206 +70,633 @@ st.set_page_config(
     layout="wide"
 )
 
+# Number of chat messages kept in (and re-rendered from) the session history
+MAX_HISTORY = 50
+
+# Upper bounds (in seconds) and labels of the subagent latency buckets shown in the sidebar
+LATENCY_BUCKETS = [(1, "<1s"), (5, "1-5s"), (15, "5-15s"), (float("inf"), ">15s")]
+
+# Chat command that runs the researcher subagent directly, with results cached by topic
+RESEARCH_COMMAND = "/research"
+
+# Follow-up messages sent within this many seconds of each other are answered in one agent turn...
+COALESCE_WINDOW = 0.3
+# ...unless this many are already waiting
+COALESCE_MAX = 3
+
+def _run_loop(loop: asyncio.AbstractEventLoop):
+    """Run a session's event loop until it is stopped, then close it."""
+    loop.run_forever()
+    loop.close()
+
+
+def _shutdown_session(loop: asyncio.AbstractEventLoop, clients: dict) -> Future | None:
+    """Close all clients of a finished session and stop its event loop, without blocking the caller."""
+    if loop.is_closed():
+        return None
+    entries = list(clients.values())
+
+    async def shutdown():
+        for entry in entries:
+            entry["close_event"].set()
+        await asyncio.gather(*(asyncio.wrap_future(entry["owner"]) for entry in entries), return_exceptions=True)
+        loop.stop()
+
+    return asyncio.run_coroutine_threadsafe(shutdown(), loop)
+
+
+def _shutdown_live_sessions(sessions: weakref.WeakSet):
+    """Shut down every session still open when the server exits, waiting while the loop threads are alive."""
+    futures = [future for session in list(sessions) if (future := session.shutdown()) is not None]
+    wait_for_futures(futures, timeout=10)
+
+
+@st.cache_resource
+def _live_sessions() -> weakref.WeakSet:
+    """Process-wide set of open sessions, shut down by a single exit hook."""
+    sessions = weakref.WeakSet()
+    atexit.register(_shutdown_live_sessions, sessions)
+    return sessions
+
+
+class SessionLifetime:
+    """Kept in session state so it is garbage collected together with the session."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, clients: dict):
+        # The finalizer only schedules the shutdown; at exit the blocking hook above runs it instead
+        self._finalizer = weakref.finalize(self, _shutdown_session, loop, clients)
+        self._finalizer.atexit = False
+        _live_sessions().add(self)
+
+    def shutdown(self) -> Future | None:
+        """Shut the session down now, if that has not happened yet."""
+        return self._finalizer()
+
+
 # Initialize session state
 if "messages" not in st.session_state:
     st.session_state.messages = []
-if "client" not in st.session_state:
-    st.session_state.client = None
+if "clients" not in st.session_state:
+    # Connected clients by profile: "text" (no browser) and "browser" (Playwright MCP)
+    st.session_state.clients = {}
+if "profile" not in st.session_state:
+    # Client profile for this conversation, chosen from its first message
+    st.session_state.profile = None
+if "loop" not in st.session_state:
+    # One long-lived event loop per session, running in a background thread, so the
+    # connected client and its MCP servers survive reruns
+    st.session_state.loop = asyncio.new_event_loop()
+    threading.Thread(
+        target=_run_loop,
+        args=(st.session_state.loop,),
+        name="claude-sdk-loop",
+        daemon=True
+    ).start()
+    # Shuts the loop and clients down once Streamlit drops the session, or when the server exits
+    st.session_state.lifetime = SessionLifetime(st.session_state.loop, st.session_state.clients)
+if "prewarm" not in st.session_state:
+    st.session_state.prewarm = False
 if "model" not in st.session_state:
     st.session_state.model = "sonnet"
+if "current_turn" not in st.session_state:
+    st.session_state.current_turn = None
+if "turn_lock" not in st.session_state:
+    # Serializes turns on the shared client, including the cleanup of a superseded turn
+    st.session_state.turn_lock = asyncio.Lock()
+if "pending" not in st.session_state:
+    # (submit time, prompt) of chat messages waiting to be answered
+    st.session_state.pending = []
+    st.session_state.submitted_count = 0
+    st.session_state.merged_count = 0
+if "max_parallel" not in st.session_state:
+    st.session_state.max_parallel = 3
+if "metrics" not in st.session_state:
+    # Wall time in seconds of each completed subagent run, by subagent
+    st.session_state.metrics = {}
+
+
+# Models offered in the sidebar
+MODELS = ["sonnet", "opus", "haiku"]
+
+# Tool groups shared by the main agent and the subagents
+BASE_FS_TOOLS: tuple[str, ...] = (
+    'Read',
+    'Write',
+    'Edit',
+    'MultiEdit',
+    'Grep',
+    'Glob',
+    'TodoWrite',
+)
+
+WEB_TOOLS: tuple[str, ...] = (
+    'WebSearch',
+    'WebFetch',
+)
+
+PLAYWRIGHT_TOOLS: tuple[str, ...] = (
+    'mcp__Playwright__browser_close',
+    'mcp__Playwright__browser_resize',
+    'mcp__Playwright__browser_console_messages',
+    'mcp__Playwright__browser_handle_dialog',
+    'mcp__Playwright__browser_evaluate',
+    'mcp__Playwright__browser_file_upload',
+    'mcp__Playwright__browser_fill_form',
+    'mcp__Playwright__browser_install',
+    'mcp__Playwright__browser_press_key',
+    'mcp__Playwright__browser_type',
+    'mcp__Playwright__browser_navigate',
+    'mcp__Playwright__browser_navigate_back',
+    'mcp__Playwright__browser_network_requests',
+    'mcp__Playwright__browser_take_screenshot',
+    'mcp__Playwright__browser_snapshot',
+    'mcp__Playwright__browser_click',
+    'mcp__Playwright__browser_drag',
+    'mcp__Playwright__browser_hover',
+    'mcp__Playwright__browser_select_option',
+    'mcp__Playwright__browser_tabs',
+    'mcp__Playwright__browser_wait_for',
+)
+
+# Hashed lookup for per-tool-call checks; the SDK itself needs plain lists, as it serializes tools to JSON
+PLAYWRIGHT_TOOL_SET = frozenset(PLAYWRIGHT_TOOLS)
+
+
+# Model-independent agent configuration, built once at import
+_ALLOWED_TOOLS = [
+    *BASE_FS_TOOLS,
+    # Task tool is required to use subagents!
+    'Task',
+    *WEB_TOOLS,
+    *PLAYWRIGHT_TOOLS,
+]
+
+# We can also specify allowed tools for subagents, by default they inherit all tools including MCP tools.
+_AGENTS = {
+    "youtube-analyst": AgentDefinition(
+        description="An expert at analyzing a user's Youtube channel performance. The analyst will produce a markdown report in the /docs directory.",
+        prompt="You are an expert at analyzing YouTube data and helping the user understand their performance. You can use the Playwright browser tools to access the user's Youtube Studio. Generate a markdown report in the /docs directory.",
+        # Browser-driven data gathering fits comfortably within haiku
+        model="haiku",
+        tools=list(BASE_FS_TOOLS + PLAYWRIGHT_TOOLS)
+    ),
+    "researcher": AgentDefinition(
+        description="An expert researcher and documentation writer. The agent will perform deep research of a topic and generate a report or documentation in the /docs directory.",
+        prompt="You are an expert researcher and report/documentation writer. Use the WebSearch and WebFetch tools to perform research. You can research multiple subtopics/angles to get a holistic understanding of the topic. You can use filesystem tools to track findings and data in the /docs directory. For longer reports, you can break the work into multiple tasks or write sections at a time. But the final output should be a single markdown report. The final report **MUST** include a citations section with links to all sources used. Review the full report, identify any areas for improvement in readability, cohorerence, and relevancy, and make any necessary edits before declaring the task complete. Clean up any extraneous files and only leave the final report in the /docs directory when you are done. You are only permitted to use these specific tools: Read, Write, Edit, MultiEdit, Grep, Glob, TodoWrite, WebSearch, WebFetch. All other tools are prohibited.",
+        model="sonnet",
+        tools=list(BASE_FS_TOOLS + WEB_TOOLS)
+    ),
+    "events_agent": AgentDefinition(
+        description="You are gathering incoming AI events in bay area. Asking for the input of how many days you want to check, search for sources from https://luma.com/sf, Meetup, eventbrite, startupgrind, Y combinator, 500 startups, Andreessen Horowitz (a16z), Stanford Events, Berkeley Events, LinkedIn Events, Silicon Valley Forum, Galvanize, StrictlyVC, Bay Area Tech Events, cerebralvalley.ai/events , you must include RSVP URL.",
+        prompt="You are searching for AI events in the next few days. Ask for how many days in advance. Gather the events, make sure to include event title, location and RSVP URL, don't include status. Display the events in UI in a friendly format.",
+        model="haiku",
+        tools=list(BASE_FS_TOOLS + PLAYWRIGHT_TOOLS)
+    )
+}
+
+# Note: Playwright requires Node.js and Chrome to be installed!
+_MCP_SERVERS = {
+    "Playwright": {
+        "command": "npx",
+        "args": [
+            "-y",
+            "@playwright/mcp@latest"
+        ]
+    },
+    "chrome-devtools": {
+        "command": "npx",
+        "args": [
+            "chrome-devtools-mcp@latest"
+        ]
+    }
+}
+
+# Tool and subagent subset for chats that never touch the browser, so no MCP servers are started
+_TEXT_ALLOWED_TOOLS = [tool for tool in _ALLOWED_TOOLS if tool not in PLAYWRIGHT_TOOL_SET]
+_BROWSER_AGENTS = frozenset(
+    name for name, agent in _AGENTS.items() if not PLAYWRIGHT_TOOL_SET.isdisjoint(agent.tools)
+)
+
+# Prompts mentioning any of these are answered by the browser-enabled client
+BROWSER_KEYWORDS = ("youtube", "browse", "browser", "event", "website", "screenshot", "playwright")
 
 
-def get_claude_options(model: str):
-    """Configure Claude agent options with subagents."""
+def needs_browser(prompt: str) -> bool:
+    """Cheap keyword check for prompts that need the Playwright browser subagents."""
+    prompt = prompt.lower()
+    return any(keyword in prompt for keyword in BROWSER_KEYWORDS)
+
+
+def _parallel_prompt(max_parallel: int) -> str:
+    """Instructions for fanning independent work out to concurrent subagents."""
+    if max_parallel <= 1:
+        return "Delegate to one subagent at a time and wait for its result before starting the next."
+    return (
+        "When a request involves several independent subtasks for your subagents, delegate them concurrently: "
+        f"issue up to {max_parallel} Task tool calls in a single message instead of waiting for each one to finish. "
+        "Only run subagents one after another when a later task depends on an earlier task's result."
+    )
+
+
+# Options only depend on the settings, so build them once and share them across reruns and sessions
+@st.cache_resource
+def get_claude_options(model: str, max_parallel: int, agent_models: dict[str, str], browser: bool):
+    """Configure Claude agent options with subagents, using the given model for each subagent.
+
+    Without browser, the Playwright tools, the browser subagents and the MCP servers are left out.
+    """
     return ClaudeAgentOptions(
         model=model,
+        # Task calls issued in the same assistant message run concurrently
+        system_prompt={"type": "preset", "preset": "claude_code", "append": _parallel_prompt(max_parallel)},
         permission_mode="bypassPermissions",  # Bypass all permission prompts for MCP tools
         setting_sources=["project"],
-        allowed_tools=[
-            'Read',
-            'Write',
-            'Edit',
-            'MultiEdit',
-            'Grep',
-            'Glob',
-            # Task tool is required to use subagents!
-            'Task',
-            'TodoWrite',
-            'WebSearch',
-            'WebFetch',
-            'mcp__Playwright__browser_close',
-            'mcp__Playwright__browser_resize',
-            'mcp__Playwright__browser_console_messages',
-            'mcp__Playwright__browser_handle_dialog',
-            'mcp__Playwright__browser_evaluate',
-            'mcp__Playwright__browser_file_upload',
-            'mcp__Playwright__browser_fill_form',
-            'mcp__Playwright__browser_install',
-            'mcp__Playwright__browser_press_key',
-            'mcp__Playwright__browser_type',
-            'mcp__Playwright__browser_navigate',
-            'mcp__Playwright__browser_navigate_back',
-            'mcp__Playwright__browser_network_requests',
-            'mcp__Playwright__browser_take_screenshot',
-            'mcp__Playwright__browser_snapshot',
-            'mcp__Playwright__browser_click',
-            'mcp__Playwright__browser_drag',
-            'mcp__Playwright__browser_hover',
-            'mcp__Playwright__browser_select_option',
-            'mcp__Playwright__browser_tabs',
-            'mcp__Playwright__browser_wait_for',
-        ],
-        # We can also specify allowed tools for subagents, by default they inherit all tools including MCP tools.
+        allowed_tools=_ALLOWED_TOOLS if browser else _TEXT_ALLOWED_TOOLS,
         agents={
-            "youtube-analyst": AgentDefinition(
-                description="An expert at analyzing a user's Youtube channel performance. The analyst will produce a markdown report in the /docs directory.",
-                prompt="You are an expert at analyzing YouTube data and helping the user understand their performance. You can use the Playwright browser tools to access the user's Youtube Studio. Generate a markdown report in the /docs directory.",
-                model="sonnet",
-                tools=[
-                    'Read',
-                    'Write',
-                    'Edit',
-                    'MultiEdit',
-                    'Grep',
-                    'Glob',
-                    'TodoWrite',
-                    'mcp__Playwright__browser_close',
-                    'mcp__Playwright__browser_resize',
-                    'mcp__Playwright__browser_console_messages',
-                    'mcp__Playwright__browser_handle_dialog',
-                    'mcp__Playwright__browser_evaluate',
-                    'mcp__Playwright__browser_file_upload',
-                    'mcp__Playwright__browser_fill_form',
-                    'mcp__Playwright__browser_install',
-                    'mcp__Playwright__browser_press_key',
-                    'mcp__Playwright__browser_type',
-                    'mcp__Playwright__browser_navigate',
-                    'mcp__Playwright__browser_navigate_back',
-                    'mcp__Playwright__browser_network_requests',
-                    'mcp__Playwright__browser_take_screenshot',
-                    'mcp__Playwright__browser_snapshot',
-                    'mcp__Playwright__browser_click',
-                    'mcp__Playwright__browser_drag',
-                    'mcp__Playwright__browser_hover',
-                    'mcp__Playwright__browser_select_option',
-                    'mcp__Playwright__browser_tabs',
-                    'mcp__Playwright__browser_wait_for',
-                ]
-            ),
-            "researcher": AgentDefinition(
-                description="An expert researcher and documentation writer. The agent will perform deep research of a topic and generate a report or documentation in the /docs directory.",
-                prompt="You are an expert researcher and report/documentation writer. Use the WebSearch and WebFetch tools to perform research. You can research multiple subtopics/angles to get a holistic understanding of the topic. You can use filesystem tools to track findings and data in the /docs directory. For longer reports, you can break the work into multiple tasks or write sections at a time. But the final output should be a single markdown report. The final report **MUST** include a citations section with links to all sources used. Review the full report, identify any areas for improvement in readability, cohorerence, and relevancy, and make any necessary edits before declaring the task complete. Clean up any extraneous files and only leave the final report in the /docs directory when you are done. You are only permitted to use these specific tools: Read, Write, Edit, MultiEdit, Grep, Glob, TodoWrite, WebSearch, WebFetch. All other tools are prohibited.",
-                model="sonnet",
-                tools=[
-                    'Read',
-                    'Write',
-                    'Edit',
-                    'MultiEdit',
-                    'Grep',
-                    'Glob',
-                    'TodoWrite',
-                    'WebSearch',
-                    'WebFetch',
-                ]
-            ),
-            "events_agent": AgentDefinition(
-                description="You are gathering incoming AI events in bay area. Asking for the input of how many days you want to check, search for sources from https://luma.com/sf, Meetup, eventbrite, startupgrind, Y combinator, 500 startups, Andreessen Horowitz (a16z), Stanford Events, Berkeley Events, LinkedIn Events, Silicon Valley Forum, Galvanize, StrictlyVC, Bay Area Tech Events, cerebralvalley.ai/events , you must include RSVP URL.",
-                prompt="You are searching for AI events in the next few days. Ask for how many days in advance. Gather the events, make sure to include event title, location and RSVP URL, don't include status. Display the events in UI in a friendly format.",
-                model="sonnet",
-                tools=[
-                    'Read',
-                    'Write',
-                    'Edit',
-                    'MultiEdit',
-                    'Grep',
-                    'Glob',
-                    'TodoWrite',
-                    'mcp__Playwright__browser_close',
-                    'mcp__Playwright__browser_resize',
-                    'mcp__Playwright__browser_console_messages',
-                    'mcp__Playwright__browser_handle_dialog',
-                    'mcp__Playwright__browser_evaluate',
-                    'mcp__Playwright__browser_file_upload',
-                    'mcp__Playwright__browser_fill_form',
-                    'mcp__Playwright__browser_install',
-                    'mcp__Playwright__browser_press_key',
-                    'mcp__Playwright__browser_type',
-                    'mcp__Playwright__browser_navigate',
-                    'mcp__Playwright__browser_navigate_back',
-                    'mcp__Playwright__browser_network_requests',
-                    'mcp__Playwright__browser_take_screenshot',
-                    'mcp__Playwright__browser_snapshot',
-                    'mcp__Playwright__browser_click',
-                    'mcp__Playwright__browser_drag',
-                    'mcp__Playwright__browser_hover',
-                    'mcp__Playwright__browser_select_option',
-                    'mcp__Playwright__browser_tabs',
-                    'mcp__Playwright__browser_wait_for',
-                ]
-            )
+            name: replace(agent, model=agent_models[name])
+            for name, agent in _AGENTS.items()
+            if browser or name not in _BROWSER_AGENTS
         },
-        # Note: Playwright requires Node.js and Chrome to be installed!
-        mcp_servers={
-            "Playwright": {
-                "command": "npx",
-                "args": [
-                    "-y",
-                    "@playwright/mcp@latest"
-                ]
-            },
-            "chrome-devtools": {
-                "command": "npx",
-                "args": [
-                    "chrome-devtools-mcp@latest"
-                ]
-            }
-        }
+        mcp_servers=_MCP_SERVERS if browser else {}
     )
 
 
-async def process_message(user_input: str, model: str):
-    """Process user message and get response from Claude."""
-    logger.info(f"Processing user input: {user_input[:100]}...")
-    options = get_claude_options(model)
+def add_message(role: str, content: str):
+    """Append a message to the chat history, keeping only the most recent MAX_HISTORY entries."""
+    st.session_state.messages.append({"role": role, "content": content})
+    del st.session_state.messages[:-MAX_HISTORY]
+
+
+async def _own_client(client: ClaudeSDKClient, profile: str, connected: Future, close_event: asyncio.Event):
+    """Keep a client connected until close_event is set.
+
+    The SDK enters an anyio task group on connect that must be exited from the same task, so one
+    task owns each client from connect to disconnect.
+    """
+    try:
+        async with client:
+            logger.info(f"Claude SDK client connected ({profile})")
+            connected.set_result(client)
+            await close_event.wait()
+    except Exception as e:
+        if not connected.done():
+            connected.set_exception(e)
+        else:
+            logger.warning(f"Error closing Claude SDK client: {e}")
+    finally:
+        # Never leave a waiting get_client hanging, e.g. if the loop shuts down mid-connect
+        if not connected.done():
+            connected.cancel()
+
+
+def _close_client(entry: dict, loop: asyncio.AbstractEventLoop, wait: bool = True):
+    """Ask a client's owner task to disconnect, by default waiting for it to finish."""
+    if loop.is_closed() or not loop.is_running():
+        return
+    loop.call_soon_threadsafe(entry["close_event"].set)
+    if not wait:
+        return
+    try:
+        entry["owner"].result(timeout=10)
+    except TimeoutError:
+        logger.warning("Timed out closing Claude SDK client")
+    except Exception as e:
+        logger.warning(f"Error closing Claude SDK client: {e!r}")
+
+
+def close_client(profile: str, wait: bool = True):
+    """Disconnect and forget the session's client for a profile, if it has one.
+
+    Without waiting, a client that is still connecting disconnects in the background once it is up.
+    """
+    entry = st.session_state.clients.pop(profile, None)
+    if entry is not None:
+        _close_client(entry, st.session_state.loop, wait)
+
+
+def connect_client(profile: str, options: ClaudeAgentOptions) -> Future:
+    """Start connecting the session's client for a profile in the background, reusing a live or pending connection."""
+    entry = st.session_state.clients.get(profile)
+    if entry is not None:
+        connected = entry["connected"]
+        failed = connected.done() and connected.exception() is not None
+        # Options are cached, so unchanged settings give back the very same object
+        if entry["options"] is options and not failed:
+            return connected
+        logger.info(f"Settings changed or connection failed, reconnecting {profile} Claude SDK client")
+        close_client(profile)
+
+    connected = Future()
+    close_event = asyncio.Event()
+    owner = asyncio.run_coroutine_threadsafe(
+        _own_client(ClaudeSDKClient(options=options), profile, connected, close_event),
+        st.session_state.loop
+    )
+    st.session_state.clients[profile] = {
+        "options": options,
+        "connected": connected,
+        "close_event": close_event,
+        "owner": owner
+    }
+    return connected
 
-    async with ClaudeSDKClient(options=options) as client:
-        await client.query(user_input)
-        logger.info("Query sent to Claude SDK")
 
-        response_text = ""
-        async for message in client.receive_response():
-            # Log the message activity to console
-            if hasattr(message, 'content'):
-                if isinstance(message.content, list):
-                    for content_block in message.content:
-                        # Log tool usage to console
-                        if hasattr(content_block, 'type') and content_block.type == 'tool_use':
-                            tool_name = getattr(content_block, 'name', 'unknown')
-                            tool_input = getattr(content_block, 'input', {})
-                            logger.info(f"🔧 Using tool: {tool_name}")
-                            logger.debug(f"Tool input: {tool_input}")
-
-                        # Extract text content
-                        if hasattr(content_block, 'text'):
-                            response_text += content_block.text
-                elif hasattr(message.content, 'text'):
-                    response_text += message.content.text
-
-        logger.info(f"Response received, length: {len(response_text)} characters")
-        return response_text
+def get_client(profile: str, options: ClaudeAgentOptions) -> ClaudeSDKClient:
+    """Return the session's connected client for a profile, waiting for it to connect if needed."""
+    return connect_client(profile, options).result()
 
 
-# Sidebar
-with st.sidebar:
-    st.title("⚙️ Settings")
+def selected_agent_models() -> dict[str, str]:
+    """Subagent models currently selected in the sidebar, by agent name."""
+    return {name: st.session_state[f"agent_model_{name}"] for name in _AGENTS}
+
+
+def current_options(browser: bool) -> ClaudeAgentOptions:
+    """Claude agent options for the settings currently selected in the sidebar."""
+    return get_claude_options(
+        st.session_state.model,
+        st.session_state.max_parallel,
+        selected_agent_models(),
+        browser
+    )
+
+
+@dataclass
+class SubagentRun:
+    """Wall time of one completed subagent (Task tool) call."""
+
+    name: str
+    seconds: float
+
 
+def _iter_blocks(message: Message):
+    """Yield the text, tool use and tool result blocks of a message."""
+    # Assistant messages carry the response text and tool calls, user messages carry the tool results
+    # https://docs.claude.com/en/api/agent-sdk/python#content-block-types
+    if isinstance(message, AssistantMessage):
+        for block in message.content:
+            if isinstance(block, (TextBlock, ToolUseBlock)):
+                yield block
+    elif isinstance(message, UserMessage) and isinstance(message.content, list):
+        for block in message.content:
+            if isinstance(block, ToolResultBlock):
+                yield block
+
+
+async def process_message(user_input: str, client: ClaudeSDKClient, turn_lock: asyncio.Lock):
+    """Process user message and stream Claude's text and tool use blocks, plus subagent timings, as they arrive."""
+    async with turn_lock:
+        logger.info(f"Processing user input: {user_input[:100]}...")
+
+        await client.query(user_input)
+        logger.info("Query sent to Claude SDK")
+
+        response_length = 0
+        # Start time and subagent name of each running Task call, by tool use id
+        task_starts = {}
+        try:
+            async for message in client.receive_response():
+                for block in _iter_blocks(message):
+                    if isinstance(block, ToolResultBlock):
+                        started = task_starts.pop(block.tool_use_id, None)
+                        if started is not None:
+                            run = SubagentRun(started[0], time.perf_counter() - started[1])
+                            logger.info(f"⏱️ Subagent {run.name} finished in {run.seconds:.1f}s")
+                            yield run
+                        continue
+
+                    # Log tool usage to console
+                    if isinstance(block, ToolUseBlock):
+                        logger.info(f"🔧 Using tool: {block.name}")
+                        logger.debug(f"Tool input: {block.input}")
+                        if block.name == "Task":
+                            task_starts[block.id] = (block.input.get("subagent_type", "unknown"), time.perf_counter())
+                    else:
+                        response_length += len(block.text)
+                    yield block
+        except asyncio.CancelledError:
+            logger.info("Turn cancelled, interrupting Claude")
+            # Stop the model and any running tools, then drain the interrupted turn so the next query starts clean
+            await client.interrupt()
+            async for _ in client.receive_response():
+                pass
+            raise
+
+        logger.info(f"Response received, length: {response_length} characters")
+
+
+def latency_buckets(metrics: dict[str, list[float]]) -> list[dict]:
+    """Count subagent runs per latency bucket, one row per bucket with a count per subagent."""
+    rows = [{"Latency": label, **dict.fromkeys(metrics, 0)} for _, label in LATENCY_BUCKETS]
+    for name, durations in metrics.items():
+        for seconds in durations:
+            index = next(i for i, (upper, _) in enumerate(LATENCY_BUCKETS) if seconds < upper)
+            rows[index][name] += 1
+    return rows
+
+
+def response_text(blocks, status):
+    """Yield the response text for st.write_stream, reporting tool calls and subagent timings on the status widget."""
+    label = "Thinking..."
+    for block in blocks:
+        if block is None:
+            # Touching the status while idle lets Streamlit act on a Stop click mid-turn
+            status.update(label=label)
+        elif isinstance(block, SubagentRun):
+            st.session_state.metrics.setdefault(block.name, []).append(block.seconds)
+            status.write(f"⏱️ {block.name} finished in {block.seconds:.1f}s")
+        elif isinstance(block, ToolUseBlock):
+            if block.name in PLAYWRIGHT_TOOL_SET:
+                label = f"🌐 Browser: {block.name.removeprefix('mcp__Playwright__browser_')}"
+            else:
+                label = f"🔧 Using tool: {block.name}"
+            status.update(label=label)
+            status.write(label)
+        else:
+            yield block.text
+
+
+def normalize_query(text: str) -> str:
+    """Normalize a research topic so trivially different phrasings share a cache entry."""
+    return re.sub(r"\s+", " ", text.strip().lower())
+
+
+async def _run_research(topic: str, model: str):
+    """Run the researcher subagent's prompt and tools as a one-off query, yielding its text and tool use blocks.
+
+    Raises RuntimeError if the run fails or produces no text, so it never reaches the cache.
+    """
+    logger.info(f"Running research for: {topic[:100]}")
+    researcher = _AGENTS["researcher"]
+    options = ClaudeAgentOptions(
+        model=model,
+        system_prompt={"type": "preset", "preset": "claude_code", "append": researcher.prompt},
+        permission_mode="bypassPermissions",
+        setting_sources=["project"],
+        allowed_tools=researcher.tools
+    )
+    result = None
+    has_text = False
+    async for message in query(prompt=topic, options=options):
+        if isinstance(message, ResultMessage):
+            result = message
+        for block in _iter_blocks(message):
+            if isinstance(block, (TextBlock, ToolUseBlock)):
+                has_text = has_text or (isinstance(block, TextBlock) and bool(block.text.strip()))
+                yield block
+    if result is None:
+        raise RuntimeError("Research ended without a result")
+    if result.is_error:
+        raise RuntimeError(f"Research failed: {result.result or result.subtype}")
+    if not has_text:
+        raise RuntimeError("Research returned no report")
+
+
+# Persisted to disk so restarts keep the cache (Streamlit ignores ttl for persisted caches)
+@st.cache_data(persist="disk", show_spinner=False)
+def research_cache(query_norm: str, model: str, _report: str | None = None) -> str:
+    """Cached research report for a normalized topic and model.
+
+    Called without a report this is a lookup, raising LookupError on a miss (exceptions are not cached);
+    called with the report of a finished run it stores it. The report is left out of the cache key.
+    """
+    if _report is None:
+        raise LookupError(query_norm)
+    return _report
+
+
+_STREAM_END = object()
+
+# Seconds to wait for the next chunk before yielding None to the script thread
+_IDLE_TIMEOUT = 0.5
+
+
+def stream_response(chunks, loop: asyncio.AbstractEventLoop):
+    """Drain an async generator on the background loop into a sync generator, yielding None while idle."""
+    chunk_queue = queue.Queue()
+    text = []
+
+    async def pump():
+        try:
+            async for chunk in chunks:
+                if isinstance(chunk, TextBlock):
+                    text.append(chunk.text)
+                chunk_queue.put(chunk)
+        finally:
+            chunk_queue.put(_STREAM_END)
+
+    future = asyncio.run_coroutine_threadsafe(pump(), loop)
+    # Keep a handle on the in-flight turn so the Stop button can cancel it and keep what it has said so far
+    st.session_state.current_turn = {"future": future, "text": text, "recorded": False}
+    while True:
+        try:
+            chunk = chunk_queue.get(timeout=_IDLE_TIMEOUT)
+        except queue.Empty:
+            yield None
+            continue
+        if chunk is _STREAM_END:
+            break
+        yield chunk
+    # Surface any error raised while streaming
+    future.result()
+
+
+def record_turn(content: str):
+    """Add the assistant's reply for the current turn to the chat history."""
+    turn = st.session_state.current_turn
+    if turn is not None:
+        turn["recorded"] = True
+    add_message("assistant", content)
+
+
+def stop_current_turn() -> str | None:
+    """Cancel the current turn if it is still streaming, and record and return whatever it produced.
+
+    Stopping reruns the script, which ends the run that was streaming the turn before it could record it.
+    """
+    turn = st.session_state.current_turn
+    if turn is None or turn["recorded"]:
+        return None
+    future = turn["future"]
+    text = "".join(turn["text"])
+    if future.cancel():
+        logger.info("Stopped streaming turn")
+        content = f"{text}\n\n_Stopped._" if text else "_Stopped._"
+    elif future.exception() is not None:
+        content = f"Error: {future.exception()}"
+    else:
+        content = text
+    record_turn(content)
+    return content
+
+
+def next_pending_batch() -> str | None:
+    """Take the oldest pending messages that were sent within COALESCE_WINDOW of each other as one turn input.
+
+    A message left behind by a rerun that was not a chat submission (Stop, Clear, a sidebar toggle) is older
+    than that, so it gets a turn of its own instead of joining whatever is sent next. Batches are taken one turn
+    at a time, so a rerun during one turn leaves the later ones pending.
+    """
+    pending = st.session_state.pending
+    if not pending:
+        return None
+    count = 1
+    while count < len(pending) and pending[count][0] - pending[count - 1][0] <= COALESCE_WINDOW:
+        count += 1
+    st.session_state.pending = pending[count:]
+    st.session_state.merged_count += count - 1
+    return "\n".join(prompt for _, prompt in pending[:count])
+
+
+# Subagents start on their default models until overridden in the sidebar
+for name, agent in _AGENTS.items():
+    if f"agent_model_{name}" not in st.session_state:
+        st.session_state[f"agent_model_{name}"] = agent.model
+
+# When enabled in the sidebar, start the browser client in the background so the first browser prompt
+# skips the CLI and MCP server cold start; this also re-warms it after the chat is cleared
+if st.session_state.prewarm and st.session_state.profile is None and "browser" not in st.session_state.clients:
+    connect_client("browser", current_options(browser=True))
+
+
+# Settings run as a fragment: changing them only reruns this block, so the chat history is not
+# re-rendered and a response that is still streaming is not interrupted. A new setting takes effect
+# on the next message.
+@st.fragment
+def settings():
     # Model selection
     model_option = st.selectbox(
         "Select Model",
-        ["sonnet", "opus", "haiku"],
+        MODELS,
         index=0
     )
     st.session_state.model = model_option
+    # Drawn here rather than in the main body so it updates with the fragment
+    st.caption(f"Using model: {st.session_state.model}")
+
+    # Upper bound on subagents the main agent may run at the same time
+    st.slider(
+        "Max Parallel Subagents",
+        min_value=1,
+        max_value=5,
+        key="max_parallel"
+    )
+
+    # Per-subagent model overrides ("inherit" uses the main model)
+    with st.expander("Advanced"):
+        for name in _AGENTS:
+            st.selectbox(
+                f"{name} model",
+                MODELS + ["inherit"],
+                key=f"agent_model_{name}"
+            )
+
+
+# Sidebar
+with st.sidebar:
+    st.title("⚙️ Settings")
+
+    settings()
 
     st.divider()
 
@@ -243,11 +707,55 @@ with st.sidebar:
     - **documentation-writer**: Creates technical documentation
     - **events_agent**: Gathers upcoming AI events in the Bay Area
     """)
+    st.caption(f"Use `{RESEARCH_COMMAND} <topic>` to run the researcher directly; repeated topics are served from cache.")
+    if st.button("♻️ Clear Research Cache", help="Forget cached reports so topics are researched again"):
+        research_cache.clear()
+        st.toast("Research cache cleared")
+
+    st.toggle(
+        "Pre-warm browser tools",
+        key="prewarm",
+        help="Start the Playwright MCP servers in the background when the session opens"
+    )
+    browser = st.session_state.clients.get("browser")
+    if browser is not None:
+        connected = browser["connected"]
+        if not connected.done():
+            st.caption("⏳ Starting browser tools...")
+        elif connected.exception() is not None:
+            st.caption("⚠️ Browser tools unavailable")
+        else:
+            st.caption("🟢 MCP ready")
 
     st.divider()
 
+    if st.session_state.metrics:
+        st.subheader("⏱️ Subagent Latency")
+        # Keep the buckets in order rather than sorting their labels
+        st.bar_chart(latency_buckets(st.session_state.metrics), x="Latency", sort=False)
+
+    # Share of submitted messages that were folded into another message's turn
+    submitted_count = st.session_state.submitted_count
+    merge_rate = st.session_state.merged_count / submitted_count if submitted_count else 0
+    st.metric("Merged Messages", f"{merge_rate:.0%}")
+
+    st.divider()
+
+    if st.button("⏹️ Stop"):
+        stop_current_turn()
+
     if st.button("🗑️ Clear Chat History"):
         st.session_state.messages = []
+        # Drop a turn that is still streaming without recording it into the new conversation
+        turn = st.session_state.current_turn
+        if turn is not None:
+            turn["future"].cancel()
+        st.session_state.current_turn = None
+        # Start a fresh conversation on the next message
+        for profile in list(st.session_state.clients):
+            close_client(profile)
+        st.session_state.profile = None
+        st.session_state.pending = []
         st.rerun()
 
     st.divider()
@@ -257,7 +765,6 @@ with st.sidebar:
 
 # Main chat interface
 st.title("🤖 Kaya - Your Personal Assistant")
-st.caption(f"Using model: {st.session_state.model}")
 
 # Display chat history
 for message in st.session_state.messages:
@@ -266,27 +773,79 @@ for message in st.session_state.messages:
 
 # Chat input
 if prompt := st.chat_input("What can I help you with today?"):
+    # A new message supersedes a turn that is still streaming; show what it got to before the new message
+    if (stopped := stop_current_turn()) is not None:
+        with st.chat_message("assistant"):
+            st.markdown(stopped)
+
+    # Research commands get a turn of their own; other messages wait to be coalesced
+    research = prompt.startswith(RESEARCH_COMMAND)
+
     # Add user message to chat history
-    st.session_state.messages.append({"role": "user", "content": prompt})
+    add_message("user", prompt)
+    if not research:
+        st.session_state.pending.append((time.monotonic(), prompt))
+        st.session_state.submitted_count += 1
 
     # Display user message
     with st.chat_message("user"):
         st.markdown(prompt)
 
-    # Display assistant response
-    with st.chat_message("assistant"):
-        with st.spinner("Thinking..."):
-            try:
-                # Get response from Claude (logging happens in console)
-                response = asyncio.run(process_message(prompt, st.session_state.model))
+    # Give quick follow-ups a moment to arrive; a new submission reruns the script from the next st call,
+    # so pending messages are only taken once the assistant message below has been drawn
+    if not research and len(st.session_state.pending) < COALESCE_MAX:
+        time.sleep(COALESCE_WINDOW)
 
-                # Display response
-                st.markdown(response)
+    # Research is answered as it is; otherwise answer every message that arrived in the window in a single turn
+    for turn_input in [prompt] if research else iter(next_pending_batch, None):
+        # Display assistant response, with tool activity shown as it happens
+        with st.chat_message("assistant"):
+            status = st.status("Thinking...", expanded=True)
+
+            try:
+                if research:
+                    topic = normalize_query(turn_input.removeprefix(RESEARCH_COMMAND))
+                    if not topic:
+                        raise ValueError(f"Usage: {RESEARCH_COMMAND} <topic>")
+                    research_model = selected_agent_models()["researcher"]
+                    if research_model == "inherit":
+                        research_model = st.session_state.model
+                    status.update(label=f"🔎 Researching: {topic}")
+                    try:
+                        response = research_cache(topic, research_model)
+                        st.markdown(response)
+                    except LookupError:
+                        # Stream the research on the session's loop like any other turn, so it shows progress
+                        # and can be stopped, and only cache a report that finished
+                        blocks = stream_response(_run_research(topic, research_model), st.session_state.loop)
+                        response = st.write_stream(response_text(blocks, status))
+                        research_cache(topic, research_model, _report=response)
+                else:
+                    # Pick the profile once, from the first message, so every turn of the conversation goes to the
+                    # same client and keeps its context; the browser MCP servers only start if that message needs them
+                    if st.session_state.profile is None:
+                        st.session_state.profile = "browser" if needs_browser(turn_input) else "text"
+                        if st.session_state.profile == "text":
+                            # A pre-warmed browser client may still be starting; don't make this reply wait for it
+                            close_client("browser", wait=False)
+                    profile = st.session_state.profile
+
+                    # Run on the session's background loop so the client and MCP servers stay alive between turns
+                    client = get_client(profile, current_options(profile == "browser"))
+
+                    # Stream the response as it arrives
+                    blocks = stream_response(
+                        process_message(turn_input, client, st.session_state.turn_lock),
+                        st.session_state.loop
+                    )
+                    response = st.write_stream(response_text(blocks, status))
+                status.update(label="Done", state="complete", expanded=False)
 
                 # Add assistant message to chat history
-                st.session_state.messages.append({"role": "assistant", "content": response})
+                record_turn(response)
             except Exception as e:
                 error_msg = f"Error: {str(e)}"
                 logger.error(f"Error processing message: {e}")
+                status.update(label="Failed", state="error", expanded=False)
                 st.error(error_msg)
-                st.session_state.messages.append({"role": "assistant", "content": error_msg})
+                record_turn(error_msg)